@@ -1,7 +1,52 @@
 import json
+import mmap
 import os
 import re
-from collections import Counter
+import struct
+import sys
+from array import array
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from operator import add
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Records and ids are delimited by fixed literals and found with
+# bytes.find, tag patterns work on raw bytes and only extracted title
+# and body are decoded
+_RECORD_START = b"<REUTERS"
+_RECORD_END = b"</REUTERS>"
+_ID_START = b'NEWID="'
+_TAG_RE = {
+    tag: re.compile(
+        "<{}.*?>(.*?)</{}>".format(tag, tag).encode("ascii"), re.DOTALL
+    )
+    for tag in ("TEXT", "TITLE", "BODY")
+}
+# Stands in for a failed search so that a missing tag yields b""
+_EMPTY = re.match(rb"()", b"")
+
+# State of a worker process, set up once by _init_worker
+_WORKER = {}
+
+# Leading bytes of a binary inverted index, see Indexer.save_binary_index
+_BINARY_INDEX_MAGIC = b"IRIX"
+# Magic, item size and byte order of postings, length of the term table
+_BINARY_INDEX_HEADER = struct.Struct("<4sBcI")
+
+
+class SetEncoder(json.JSONEncoder):
+    """JSON encoder that writes sets and posting arrays as lists"""
+
+    def default(self, o):
+        if isinstance(o, (set, array)):
+            return list(o)
+        return super().default(o)
 
 
 class Reader(object):
@@ -13,17 +58,22 @@ class Reader(object):
 
         Parameters
         ----------
-        raw_text: str
-            Raw text data read from file
+        raw_text: bytes or mmap.mmap
+            Raw data read from file
 
         Yields
         ------
-        str:
+        bytes:
             Record
         """
-        p = re.compile(r"<REUTERS(.*?)</REUTERS>", re.DOTALL)
-        for match in p.finditer(raw_text):
-            yield match.group(0)
+        start = raw_text.find(_RECORD_START)
+        while start >= 0:
+            end = raw_text.find(_RECORD_END, start)
+            if end < 0:
+                return
+            end += len(_RECORD_END)
+            yield raw_text[start:end]
+            start = raw_text.find(_RECORD_START, end)
 
     @staticmethod
     def get_id(record):
@@ -31,46 +81,53 @@ class Reader(object):
 
         Parameters
         ----------
-        record: str
+        record: bytes
 
         Returns
         -------
         int:
             id of the record
         """
-        p = re.compile(r'NEWID="(\d*?)"')
-        match = p.search(record)
-        if not match:
-            raise ValueError("ID cannot be found in record: {}".format(record))
-        return int(match.group(1))
+        start = record.find(_ID_START)
+        if start >= 0:
+            start += len(_ID_START)
+            end = record.find(b'"', start)
+            if end >= 0 and record[start:end].isdigit():
+                return int(record[start:end])
+        raise ValueError(
+            "ID cannot be found in record: {}".format(
+                record.decode("latin-1")
+            )
+        )
 
     @staticmethod
-    def get_tag_from_text(text, tag):
+    def get_tag_from_text(text, tag, pos=0, endpos=None):
         """Get title between <'tag'> tags
 
         Parameters
         ----------
-        text: str
+        text: bytes
             Text to extract 'tag'
+        pos: int
+            Index in text where the search starts
+        endpos: int
+            Index in text where the search ends, defaults to end of text
 
         Returns
         -------
-        str:
+        bytes:
             Matched 'tag'
         """
-        reg_pat = r"<{}.*?>(.*?)</{}>".format(tag, tag)
-        p = re.compile(reg_pat, re.DOTALL)
-        match = p.search(text)
-        if match:
-            res = match.group(1)
-        else:
-            res = ""
-
-        return res
+        if endpos is None:
+            endpos = len(text)
+        return (_TAG_RE[tag].search(text, pos, endpos) or _EMPTY).group(1)
 
     @staticmethod
     def read_input(path):
-        """Read whole file
+        """Memory-map whole file
+
+        Pages are read by the OS on demand, so the file is never
+        copied into memory as a whole
 
         Parameters
         ----------
@@ -79,11 +136,14 @@ class Reader(object):
 
         Returns
         -------
-        str:
-            Raw Text
+        mmap.mmap or bytes:
+            Read-only map of the raw file, empty bytes if file is empty
         """
         with open(path, "rb") as f:
-            return f.read().decode("latin-1")
+            # Empty files cannot be memory-mapped
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
     @classmethod
     def extract_id_document(cls, record):
@@ -91,30 +151,48 @@ class Reader(object):
 
         Parameters
         ----------
-        record: str
-            Text to extract
+        record: bytes
+            Raw record to extract
 
         Returns
         -------
-        str:
-            id, title and body
+        tuple:
+            id and decoded title and body
         """
         id_ = cls.get_id(record)
-        text = cls.get_tag_from_text(record, "TEXT").strip()
-        title = cls.get_tag_from_text(text, "TITLE").strip()
-        body = cls.get_tag_from_text(text, "BODY").strip()
+        # Title and body are searched inside the span of <TEXT> so that
+        # it is not copied, only these two small slices are decoded
+        start, end = (_TAG_RE["TEXT"].search(record) or _EMPTY).span(1)
+        title = cls.get_tag_from_text(record, "TITLE", start, end)
+        body = cls.get_tag_from_text(record, "BODY", start, end)
+        title = title.decode("latin-1").strip()
+        body = body.decode("latin-1").strip()
 
         return id_, (title + " " + body).strip()
 
     @classmethod
     def get_all_id_text(cls, paths):
-        id_text = dict([
-            cls.extract_id_document(record)
-            for path in paths
-            for record in cls.get_records(cls.read_input(path))
-        ])
+        """Get id and text of every record in given files
+
+        Records are streamed from the memory-mapped files one at a time
+
+        Parameters
+        ----------
+        paths: list
+            Paths to files
 
-        return id_text
+        Yields
+        ------
+        tuple:
+            id and text of record
+        """
+        for path in paths:
+            raw_text = cls.read_input(path)
+            if not raw_text:
+                continue
+            with raw_text:
+                for record in cls.get_records(raw_text):
+                    yield cls.extract_id_document(record)
 
 
 class Tokenizer(object):
@@ -124,7 +202,7 @@ class Tokenizer(object):
     ----------
     punctuations: list
         Puntuations that are removed from the text
-    stopwords: list
+    stopwords: frozenset
         Stopwords that are ignored when text is processed
 
     Parameters
@@ -182,10 +260,7 @@ class Tokenizer(object):
         int:
             Number of tokens in corpus
         """
-        all_tokens = []
-        for tokens in id_tokens.values():
-            all_tokens.extend(tokens)
-        return len(all_tokens)
+        return sum(map(len, id_tokens.values()))
 
     @staticmethod
     def get_number_of_terms_and_top_20(id_tokens):
@@ -201,16 +276,37 @@ class Tokenizer(object):
         tuple:
             Number of unique tokens in the corpus and top 20 frequent tokens
         """
-        all_terms = []
-        for tokens in id_tokens.values():
-            all_terms.extend(tokens)
-        top_20_terms = Counter(all_terms).most_common(20)
-        all_terms = set(all_terms)
-        return len(all_terms), top_20_terms
+        term_counts = Counter(chain.from_iterable(id_tokens.values()))
+        return len(term_counts), term_counts.most_common(20)
 
     def __init__(self, punctuations_path, stopwords_path):
         self.punctuations = self.read_punctuations(punctuations_path)
-        self.stopwords = self.read_stopwords(stopwords_path)
+        self.stopwords = frozenset(self.read_stopwords(stopwords_path))
+        self._compile()
+
+    def __getstate__(self):
+        # Only raw lists are sent to worker processes,
+        # derived tables are rebuilt on the other side
+        return self.punctuations, self.stopwords
+
+    def __setstate__(self, state):
+        self.punctuations, self.stopwords = state
+        self._compile()
+
+    def _compile(self):
+        """Build punctuation table and token pattern"""
+        # Single characters are replaced in one pass by str.translate,
+        # longer punctuations still need str.replace
+        single_punct = [punc for punc in self.punctuations if len(punc) == 1]
+        self._punct_table = str.maketrans(dict.fromkeys(single_punct, " "))
+        self._multichar_punct = [
+            punc for punc in self.punctuations if len(punc) > 1
+        ]
+
+        # Used by tokenize to do the whole procedure in a single pass
+        self._token_re = re.compile(
+            r"[^\s" + re.escape("".join(single_punct)) + r"]+"
+        )
 
     def replace_punctuations(self, text):
         """Replace punctuations for space for given text
@@ -225,7 +321,8 @@ class Tokenizer(object):
         str:
             String that punctuations are replaced with space
         """
-        for punc in self.punctuations:
+        text = text.translate(self._punct_table)
+        for punc in self._multichar_punct:
             text = text.replace(punc, " ")
         return text
 
@@ -312,20 +409,36 @@ class Tokenizer(object):
         list:
             List of tokens after tokenization procedure is applied
         """
-        # Replace punctuations and split tokens
-        tokens = self.replace_punctuations_and_split_tokens(text)
+        for punc in self._multichar_punct:
+            text = text.replace(punc, " ")
 
-        # Case-Folding
-        tokens = self.casefolding(tokens)
+        # Replace punctuations, split tokens, apply case-folding and
+        # remove stopwords at once. Tokens are interned so that every
+        # occurrence of a term shares a single string object
+        return [
+            sys.intern(token)
+            for token in self._token_re.findall(text.casefold())
+            if token not in self.stopwords
+        ]
 
-        # Remove stopwords
-        tokens = self.remove_stopwords(tokens)
 
-        return tokens
+class Indexer(object):
+    """Indexer Class
 
+    Attributes
+    ----------
+    tokenizer: Tokenizer
+        Tokenizer used while indexing files
 
-class Indexer(object):
-    """Indexer Class"""
+    Parameters
+    ----------
+    tokenizer: Tokenizer
+        Tokenizer used while indexing files, only required
+        to index files directly
+    """
+
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer
 
     @staticmethod
     def merge_indices(indices):
@@ -349,26 +462,29 @@ class Indexer(object):
 
         return output
 
-    def extract_bigram_index(self, word):
-        """Extract bigram index of giver word
+    def construct_bigram_index(self, terms):
+        """Construct bigram index of given terms
 
-        A dictionary is constructed by bigrams generated from the given word
+        Each term is expected only once, so bigrams are generated
+        per vocabulary entry rather than per occurrence
 
         Parameters
         ----------
-        word: str
-            Word to extract bigram index
+        terms: iterable
+            Unique terms to index
 
         Returns
         -------
         dict:
-            Index for given word
+            Bigram index
         """
-        bigram_index = {}
-        word_ = "$" + word + "$"
-        for i in range(0, len(word_) - 1):
-            bigram_index.setdefault(word_[i:i+2], set()).add(word)
-        return bigram_index
+        bigram_index = defaultdict(set)
+        for term in terms:
+            word_ = "$" + term + "$"
+            # Pairs adjacent characters without a Python level index loop
+            for bigram in map(add, word_, word_[1:]):
+                bigram_index[bigram].add(term)
+        return dict(bigram_index)
 
     def construct_indices_from_id_terms(self, id_terms):
         """Construct inverted index and bigram index
@@ -383,16 +499,37 @@ class Indexer(object):
         tuple:
             Inverted index and Bigram index
         """
-        inverted_index = {}
-        bigram_indices = []
-        
+        # Terms of a document are unique, so a posting never repeats an id
+        inverted_index = defaultdict(list)
         for index, terms in id_terms.items():
             for term in terms:
-                if term:
-                    inverted_index.setdefault(term, set()).add(index)
-                    bigram_indices.append(self.extract_bigram_index(term))
+                inverted_index[term].append(index)
 
-        return inverted_index, self.merge_indices(bigram_indices)
+        inverted_index = self._sort_postings(inverted_index)
+        # Keys of inverted index are exactly the vocabulary
+        return inverted_index, self.construct_bigram_index(inverted_index)
+
+    @staticmethod
+    def _sort_postings(inverted_index):
+        """Convert postings to sorted arrays
+
+        Postings are kept as sorted arrays of unsigned ints
+        rather than lists of int objects
+
+        Parameters
+        ----------
+        inverted_index: dict
+            Dict of term: list of ids
+
+        Returns
+        -------
+        dict:
+            Inverted index
+        """
+        return {
+            term: array("I", sorted(ids))
+            for term, ids in inverted_index.items()
+        }
 
     def get_id_terms(self, id_tokens):
         """Get id: terms pairs for given id: tokens pairs
@@ -428,6 +565,124 @@ class Indexer(object):
         id_terms = self.get_id_terms(id_tokens)
         return self.construct_indices_from_id_terms(id_terms)
 
+    def index_postings(self, paths):
+        """Read, tokenize and construct inverted index of given files
+
+        Token statistics are counted while documents are indexed
+
+        Parameters
+        ----------
+        paths: list
+            Paths to files
+
+        Returns
+        -------
+        tuple:
+            Inverted index and statistics. Statistics are counts of
+            terms before stopword removal and casefolding, number of
+            tokens before stopword removal and counts of terms after
+            stopword removal and casefolding
+        """
+        inverted_index = defaultdict(list)
+        raw_term_counts = Counter()
+        number_of_folded_tokens = 0
+        term_counts = Counter()
+        for id_, text in Reader.get_all_id_text(paths):
+            raw_tokens = self.tokenizer.replace_punctuations_and_split_tokens(text)
+            raw_term_counts.update(raw_tokens)
+            # Case folding keeps one token for every raw token
+            number_of_folded_tokens += len(raw_tokens)
+
+            # Indexed terms are derived from the raw tokens, so the
+            # text is tokenized once
+            tokens = [
+                sys.intern(token)
+                for token in map(str.casefold, raw_tokens)
+                if token not in self.tokenizer.stopwords
+            ]
+            term_counts.update(tokens)
+            for term in set(tokens):
+                inverted_index[term].append(id_)
+
+        statistics = raw_term_counts, number_of_folded_tokens, term_counts
+        return self._sort_postings(inverted_index), statistics
+
+    def helper(self, path):
+        """Read, tokenize and index a single file
+
+        Only the inverted index is built, bigrams are constructed
+        once over the merged vocabulary
+
+        Parameters
+        ----------
+        path: str
+            Path to file
+
+        Returns
+        -------
+        tuple:
+            Inverted index and statistics of the file,
+            see index_postings
+        """
+        return self.index_postings([path])
+
+    def construct_all_indices(self, paths, parallelism=None):
+        """Construct indices of given files in parallel
+
+        Every file is indexed by a worker process and partial inverted
+        indices are merged as they arrive. Bigram index is constructed
+        afterwards from the merged vocabulary
+
+        Parameters
+        ----------
+        paths: list
+            Paths to files
+        parallelism: int
+            Number of worker processes, defaults to number of CPUs
+
+        Returns
+        -------
+        tuple:
+            Inverted index, Bigram index and statistics,
+            see index_postings
+        """
+        inverted_index = {}
+        raw_term_counts = Counter()
+        number_of_folded_tokens = 0
+        term_counts = Counter()
+        # Terms whose postings have to be sorted again after merging
+        unsorted_terms = set()
+        # Tokenizer is sent once per worker instead of once per file
+        with ProcessPoolExecutor(
+            max_workers=parallelism,
+            initializer=_init_worker,
+            initargs=(self.tokenizer,)
+        ) as executor:
+            partials = executor.map(_worker_helper, paths)
+            # Partials are owned by this process, so postings seen for the
+            # first time are taken by reference instead of copied
+            for inverted_partial, statistics in partials:
+                # Files are merged in order, so ties in counts keep
+                # the order of a serial pass
+                raw_term_counts.update(statistics[0])
+                number_of_folded_tokens += statistics[1]
+                term_counts.update(statistics[2])
+                for term, ids in inverted_partial.items():
+                    if term in inverted_index:
+                        postings = inverted_index[term]
+                        if postings[-1] > ids[0]:
+                            unsorted_terms.add(term)
+                        postings.extend(ids)
+                    else:
+                        inverted_index[term] = ids
+
+        for term in unsorted_terms:
+            inverted_index[term] = array("I", sorted(inverted_index[term]))
+
+        bigram_index = self.construct_bigram_index(inverted_index)
+        statistics = raw_term_counts, number_of_folded_tokens, term_counts
+        return inverted_index, bigram_index, statistics
+
     @staticmethod
     def save_index(path, index):
         """Save index to given path
@@ -439,27 +694,79 @@ class Indexer(object):
         index: dict
             Index to save
         """
-        with open(path, "w") as f:
-            f.write(json.dumps(index))
+        if orjson is not None:
+            with open(path, "wb") as f:
+                f.write(orjson.dumps(index, default=list))
+        else:
+            with open(path, "w", buffering=1 << 20) as f:
+                json.dump(index, f, cls=SetEncoder)
 
     @staticmethod
-    def convert_set_to_list(dict_):
-        """Convert set valued dict to list valued dict
+    def save_binary_index(path, index):
+        """Save inverted index to given path in binary format
+
+        The file can be memory-mapped, so only the term table has to be
+        parsed when it is loaded. It consists of magic bytes, item size
+        and byte order of postings, length of the term table as
+        little-endian uint32, the term table as JSON of
+        term: [offset, count] in sorted term order, zero padding to the
+        item size, and all postings as contiguous sorted arrays of
+        unsigned ints in native byte order
 
         Parameters
         ----------
-        dict_: dict
-            Dictionary to be converted
-
-        Returns
-        -------
-        dict:
-            Converted dictionary
+        path: str
+            Path to write given index
+        index: dict
+            Inverted index to save
         """
-        return {
-            key: list(val)
-            for key, val in dict_.items()
-        }
+        postings = array("I")
+        term_table = {}
+        for term in sorted(index):
+            ids = index[term]
+            term_table[term] = [len(postings), len(ids)]
+            postings.extend(sorted(ids))
+
+        term_table = json.dumps(term_table).encode("ascii")
+        header = _BINARY_INDEX_HEADER.pack(
+            _BINARY_INDEX_MAGIC,
+            postings.itemsize,
+            sys.byteorder[0].encode("ascii"),
+            len(term_table)
+        )
+        padding = -(len(header) + len(term_table)) % postings.itemsize
+        with open(path, "wb") as f:
+            f.write(header)
+            f.write(term_table)
+            f.write(b"\0" * padding)
+            postings.tofile(f)
+
+
+def _init_worker(tokenizer):
+    """Create the indexer of a worker process
+
+    Parameters
+    ----------
+    tokenizer: Tokenizer
+        Tokenizer to index files with
+    """
+    _WORKER["indexer"] = Indexer(tokenizer)
+
+
+def _worker_helper(path):
+    """Index a single file with the indexer of the worker process
+
+    Parameters
+    ----------
+    path: str
+        Path to file
+
+    Returns
+    -------
+    tuple:
+        Inverted index and statistics of the file
+    """
+    return _WORKER["indexer"].helper(path)
 
 
 if __name__ == "__main__":
@@ -471,51 +778,36 @@ if __name__ == "__main__":
     stopwords_path = os.path.join(script_parent, "stopwords.txt")
     base_folder = os.path.join(script_parent, "reuters21578")
     inverted_index_path = os.path.join(script_parent, "Output/index.json")
+    binary_index_path = os.path.join(script_parent, "Output/index.bin")
     bigrams_path = os.path.join(script_parent, "Output/bigrams.json")
 
     if not os.path.isdir(base_folder):
         raise ValueError("Folder not found: {}".format(base_folder))
     file_paths = [os.path.join(base_folder, "reut2-{:03d}.sgm".format(i)) for i in range(22)]
 
-    reader = Reader()
-    id_text = reader.get_all_id_text(file_paths)
-
     tokenizer = Tokenizer(punctuations_path, stopwords_path)
-    # Replace punctuations and split by space
-    id_tokens = {
-        id_: tokenizer.replace_punctuations_and_split_tokens(text)
-        for id_, text in id_text.items()
-    }
-    number_of_terms, top_20_terms = tokenizer.get_number_of_terms_and_top_20(id_tokens)
+    indexer = Indexer(tokenizer)
+    # Every file is parsed once, statistics are counted while indexing
+    inverted_index, bigram_index, statistics = indexer.construct_all_indices(file_paths)
+    raw_term_counts, number_of_folded_tokens, term_counts = statistics
+
+    number_of_terms = len(raw_term_counts)
+    top_20_terms = raw_term_counts.most_common(20)
     print("Number of terms before stopword removal and casefolding: {}".format(number_of_terms))
     print("Top 20 terms before stopword removal and casefolding:")
     for term, freq in top_20_terms:
         print("Term: {}, Frequency: {}".format(term, freq))
 
-    # Case folding
-    id_tokens = {
-        id_: tokenizer.casefolding(tokens)
-        for id_, tokens in id_tokens.items()
-    }
-    number_of_tokens = tokenizer.get_number_of_tokens(id_tokens)
-    print("Number of tokens before stopword removal: {}".format(number_of_tokens))
-    # Stopword removal
-    id_tokens = {
-        id_: tokenizer.remove_stopwords(tokens)
-        for id_, tokens in id_tokens.items()
-    }
-    number_of_tokens = tokenizer.get_number_of_tokens(id_tokens)
+    print("Number of tokens before stopword removal: {}".format(number_of_folded_tokens))
+    number_of_tokens = sum(term_counts.values())
     print("Number of tokens after stopword removal: {}".format(number_of_tokens))
-    number_of_terms, top_20_terms = tokenizer.get_number_of_terms_and_top_20(id_tokens)
+    number_of_terms = len(term_counts)
+    top_20_terms = term_counts.most_common(20)
     print("Number of terms after stopword removal and casefolding: {}".format(number_of_terms))
     print("Top 20 terms after stopword removal and casefolding:")
     for term, freq in top_20_terms:
         print("Term: {}, Frequency: {}".format(term, freq))
 
-
-    indexer = Indexer()
-    inverted_index, bigram_index = indexer.construct_indices(id_tokens)
-    inverted_index = Indexer.convert_set_to_list(inverted_index)
-    bigram_index = Indexer.convert_set_to_list(bigram_index)
     Indexer.save_index(inverted_index_path, inverted_index)
+    Indexer.save_binary_index(binary_index_path, inverted_index)
     Indexer.save_index(bigrams_path, bigram_index)
@@ -1,8 +1,108 @@
 import json
+import mmap
 import os
-import re
+import struct
 import sys
-from functools import reduce
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
+
+# Posting of terms that are not in the index
+_EMPTY = ()
+# Operator separating keywords for each query type, None keeps
+# the query as a single keyword
+_SEPARATORS = {
+    "conjunctive": " AND ",
+    "disjunctive": " OR ",
+    "wildcard": None,
+}
+# Query types by their command line number, 0 is not a query type
+_QUERY_TYPES = (None, "conjunctive", "disjunctive", "wildcard")
+# Maximum number of query results kept by a processor
+_QUERY_CACHE_SIZE = 1024
+# Maximum number of wildcard expansions kept by a processor
+_TERM_CACHE_SIZE = 1024
+# Maximum number of posting sets kept by a processor
+_POSTING_SET_CACHE_SIZE = 1024
+# Leading bytes of a binary inverted index written by preprocessing.py
+_BINARY_INDEX_MAGIC = b"IRIX"
+# Magic, item size and byte order of postings, length of the term table
+_BINARY_INDEX_HEADER = struct.Struct("<4sBcI")
+_POSTING_ITEMSIZE = array("I").itemsize
+_BYTEORDER = sys.byteorder[0].encode("ascii")
+
+
+class BinaryIndex(Mapping):
+    """Read-only inverted index backed by a memory-mapped binary file
+
+    Only the term table is parsed, postings are zero-copy views into
+    the file that the OS pages in when they are read
+
+    Attributes
+    ----------
+    term_table: dict
+        Offset and number of ids of each term's posting
+
+    Parameters
+    ----------
+    path: str
+        Path to binary index written by Indexer.save_binary_index
+    """
+    __slots__ = ("term_table", "_postings")
+
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, itemsize, byteorder, table_length = (
+            _BINARY_INDEX_HEADER.unpack_from(mm)
+        )
+        if magic != _BINARY_INDEX_MAGIC:
+            raise ValueError("Not a binary index: {}".format(path))
+        # Postings are viewed in place, so they must match this machine
+        if itemsize != _POSTING_ITEMSIZE or byteorder != _BYTEORDER:
+            raise ValueError(
+                "Binary index was written on an incompatible machine: {}"
+                .format(path)
+            )
+        start = _BINARY_INDEX_HEADER.size
+        self.term_table = _loads(mm[start:start + table_length])
+
+        # Postings start at the first item aligned offset after the table
+        start += table_length
+        start += -start % _POSTING_ITEMSIZE
+        self._postings = memoryview(mm)[start:].cast("I")
+
+    def __getitem__(self, term):
+        offset, count = self.term_table[term]
+        return self._postings[offset:offset + count]
+
+    def __iter__(self):
+        return iter(self.term_table)
+
+    def __len__(self):
+        return len(self.term_table)
+
+    @staticmethod
+    def is_binary_index(path):
+        """Check whether file at given path is a binary index
+
+        Parameters
+        ----------
+        path: str
+            Path to index
+
+        Returns
+        -------
+            bool:
+                True if the file starts with the binary index magic
+        """
+        with open(path, "rb") as fp:
+            return fp.read(len(_BINARY_INDEX_MAGIC)) == _BINARY_INDEX_MAGIC
 
 
 class Processor(object):
@@ -10,23 +110,71 @@ class Processor(object):
 
     Attributes
     ----------
-    inverted_index: dict
-        Index for terms
+    inverted_index: dict or BinaryIndex
+        Index for terms, postings are sorted sequences of document ids
     bigram_index: dict
         Index for bigrams
 
     Parameters
     ----------
     inverted_index_path: str
-        Path to read inverted index
+        Path to read inverted index, either JSON or binary
     bigrams_index_path: str
         Path to read bigrams index
     """
+    __slots__ = (
+        "inverted_index",
+        "bigram_index",
+        "_posting_sets",
+        "_query_cache",
+        "_term_cache",
+    )
+
     def __init__(self, inverted_index_path, bigrams_index_path):
-        with open(inverted_index_path, "r") as fp:
-            self.inverted_index = json.load(fp)
-        with open(bigrams_index_path, "r") as fp:
-            self.bigram_index = json.load(fp)
+        # Indices are parsed from bytes, by orjson if it is installed.
+        # Both parsers detect UTF-8 regardless of locale
+        if BinaryIndex.is_binary_index(inverted_index_path):
+            self.inverted_index = BinaryIndex(inverted_index_path)
+        else:
+            with open(inverted_index_path, "rb") as fp:
+                # Preprocessing writes postings sorted, so they are used
+                # as parsed and results come out sorted
+                self.inverted_index = _loads(fp.read())
+        # Postings hashed for membership tests of recently used terms
+        self._posting_sets = OrderedDict()
+        with open(bigrams_index_path, "rb") as fp:
+            self.bigram_index = _loads(fp.read())
+        # Results of recent queries by (query, query_type)
+        self._query_cache = {}
+        # Matched terms of recent wildcard queries by (begin, end)
+        self._term_cache = OrderedDict()
+
+    def get_posting_set(self, term):
+        """Get posting of term as a set
+
+        Sets of recently used terms are kept for later queries
+
+        Parameters
+        ----------
+        term: str
+            Term to get posting
+
+        Returns
+        -------
+            frozenset:
+                Document ids of term
+        """
+        posting_set = self._posting_sets.get(term)
+        if posting_set is not None:
+            self._posting_sets.move_to_end(term)
+            return posting_set
+
+        posting_set = frozenset(self.inverted_index.get(term, _EMPTY))
+        # Least recently used set is evicted first
+        if len(self._posting_sets) >= _POSTING_SET_CACHE_SIZE:
+            self._posting_sets.popitem(last=False)
+        self._posting_sets[term] = posting_set
+        return posting_set
 
     def get_bigrams(self, begin, end):
         """Get bigrams for wildcard query
@@ -40,21 +188,17 @@ class Processor(object):
             String that shoul match with beginning
         end: str
             String that shoul match with ending
-        Returns
-        -------
-            list:
-                List of bigrams
+        Yields
+        ------
+            str:
+                Bigram
         """
         begin_, end_ = "$" + begin, end + "$"
-        bigrams_begin = [
-            begin_[i:i+2] for i in range(0, len(begin_) - 1)
-        ]
-
-        bigrams_end = [
-            end_[i:i+2] for i in range(0, len(end_) - 1)
-        ]
+        for i in range(0, len(begin_) - 1):
+            yield begin_[i:i+2]
 
-        return bigrams_begin + bigrams_end
+        for i in range(0, len(end_) - 1):
+            yield end_[i:i+2]
 
     def preprocess_query(self, query):
         """Preprocess query string
@@ -91,26 +235,20 @@ class Processor(object):
             list:
                 List of keywords to search
         """
-        
-        if query_type == "conjunctive":
-            keywords = query.split(" AND ")
-        elif query_type == "disjunctive":
-            keywords = query.split(" OR ")
-        elif query_type == "wildcard":
-            keywords = [query]
+        separator = _SEPARATORS[query_type]
+        if separator is None:
+            return [query.casefold()]
+        return [keyword.casefold() for keyword in query.split(separator)]
 
-        return [keyword.casefold() for keyword in keywords]
-
-    def get_matched_terms(self, bigrams, begin, end):
+    def get_matched_terms(self, begin, end):
         """Get matched terms
 
         It gets terms from bigram index for wildcard queries and
-        applies post filtering to get rid of false positives
+        applies post filtering to get rid of false positives.
+        Matched terms of recently used wildcards are cached
 
         Parameters
         ----------
-        bigrams: list
-            List of bigrams
         begin: str
             String that shoul match with beginning
         end: str
@@ -121,20 +259,45 @@ class Processor(object):
                 List of terms that are matched with bigrams and
                 they are 'POST-FILTERED'
         """
-        pattern = "^" + begin + ".*" + end + "$"
-        def postprocess(term):
-            if re.match(pattern, term):
-                return True
-            else:
-                return False
-
+        key = (begin, end)
+        terms = self._term_cache.get(key)
+        if terms is not None:
+            self._term_cache.move_to_end(key)
+            return list(terms)
+
+        # A bigram can repeat in a query, e.g. 'a*a', and is looked up once.
+        # An empty beginning or ending produces no bigrams on its side
+        bigrams = set(self.get_bigrams(begin, end))
+        if bigrams:
+            # A matching term contains every bigram of the query, so
+            # postings are intersected starting from the most selective
+            postings = sorted(
+                (self.bigram_index.get(bigram, ()) for bigram in bigrams),
+                key=len
+            )
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                if not candidates:
+                    break
+                candidates.intersection_update(posting)
+        else:
+            # Wildcard '*' alone matches every term
+            candidates = self.inverted_index
+        # Beginning and ending must not overlap, e.g. 'ab*ba' does not
+        # match 'aba'
+        min_length = len(begin) + len(end)
         terms = {
             term
-            for bigram in bigrams
-            for term in self.bigram_index.get(bigram, [])
-            if postprocess(term)
+            for term in candidates
+            if len(term) >= min_length
+            and term.startswith(begin) and term.endswith(end)
         }
 
+        # Least recently used wildcard is evicted first
+        if len(self._term_cache) >= _TERM_CACHE_SIZE:
+            self._term_cache.popitem(last=False)
+        self._term_cache[key] = tuple(terms)
+
         return list(terms)
 
     def get_matched_documents(self, terms, type_):
@@ -150,16 +313,35 @@ class Processor(object):
         Returns
         -------
             list:
-                List of unique document ids for qiven terms
+                Sorted list of unique document ids for qiven terms
         """
-        matched_documents_list = [set(self.inverted_index.get(term, [])) for term in terms]
+        # Bound once instead of looked up for every term
+        get_posting = self.inverted_index.get
         if type_ == "conjunctive":
-            if matched_documents_list:
-                return list(reduce(set.intersection, matched_documents_list))
-            else:
+            # Repeated terms are looked up once
+            terms = sorted(
+                dict.fromkeys(terms),
+                key=lambda term: len(get_posting(term, _EMPTY))
+            )
+            if not terms:
                 return []
-        else:   
-            return list(reduce(set.union, matched_documents_list, set()))
+            # Shortest posting is filtered by the others, so the result
+            # stays small and keeps its sorted order. Sets of the other
+            # postings are only built while something is left to filter
+            matched_documents = get_posting(terms[0], _EMPTY)
+            for term in terms[1:]:
+                if not matched_documents:
+                    break
+                posting_set = self.get_posting_set(term)
+                matched_documents = [
+                    doc for doc in matched_documents if doc in posting_set
+                ]
+            return list(matched_documents)
+        else:
+            # A k-way merge of sorted postings is slower in Python
+            # than a union followed by a sort
+            postings = [get_posting(term, _EMPTY) for term in terms]
+            return sorted(set().union(*postings))
 
     def search_qeury(self, query, query_type):
         """Search for query string
@@ -178,18 +360,34 @@ class Processor(object):
         """
         if not query:
             return []
+
+        key = (query, query_type)
+        cached = self._query_cache.get(key)
+        if cached is not None:
+            return list(cached)
+
         if query_type == "wildcard":
             if "*" not in query:
                 terms = self.get_keywords(query, query_type)
             else:
                 query = self.preprocess_query(query)
                 begin, end = query.split("*")
-                bigrams = self.get_bigrams(begin, end)
-                terms = self.get_matched_terms(bigrams, begin, end)
+                if begin or end:
+                    terms = self.get_matched_terms(begin, end)
+                else:
+                    # Every term matches, so every document is returned
+                    terms = self.inverted_index
         else:
             terms = self.get_keywords(query, query_type)
 
-        return sorted(self.get_matched_documents(terms, query_type))
+        matched_documents = self.get_matched_documents(terms, query_type)
+
+        # Oldest entry is evicted first
+        if len(self._query_cache) >= _QUERY_CACHE_SIZE:
+            del self._query_cache[next(iter(self._query_cache))]
+        self._query_cache[key] = tuple(matched_documents)
+
+        return matched_documents
 
 
 if __name__ == "__main__":
@@ -200,24 +398,22 @@ if __name__ == "__main__":
     script_dir = os.path.dirname(script_path)
     script_parent = os.path.dirname(script_dir)
 
-    inverted_index_path = os.path.join(script_parent, "Output/index.json")
+    inverted_index_path = os.path.join(script_parent, "Output/index.bin")
+    if not os.path.isfile(inverted_index_path):
+        inverted_index_path = os.path.join(script_parent, "Output/index.json")
     bigrams_path = os.path.join(script_parent, "Output/bigrams.json")
 
-    query_types = {
-        1: "conjunctive",
-        2: "disjunctive",
-        3: "wildcard"
-    }
-    processor = Processor(inverted_index_path, bigrams_path)
-
     args = sys.argv
     try:
         query_type = int(args[1])
-        query_type = query_types[query_type]
     except ValueError as ve:
         raise ValueError("Query type must be integer: {}".format(args[1]))
-    except KeyError as ke:
+    if not 0 < query_type < len(_QUERY_TYPES):
         raise KeyError("Unsupported query type: {}".format(args[1]))
-    
+    query_type = _QUERY_TYPES[query_type]
+
+    # Arguments are checked before the indices are loaded
+    processor = Processor(inverted_index_path, bigrams_path)
+
     query_str = args[2]
     print(processor.search_qeury(query_str, query_type))